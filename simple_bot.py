@@ -1,24 +1,43 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import os
+import math
+import bisect
+import functools
 import time
 import logging
 import random
+import sqlite3
+import threading
+import collections
+import concurrent.futures
+import http.server
+import urllib.parse
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import dotenv
 import jdatetime
-from PIL import Image, ImageDraw, ImageFont
-import arabic_reshaper
-from bidi.algorithm import get_display
+from PIL import Image, ImageDraw, ImageFont, features
+
+# Numba is optional: when installed, the numeric wrapping and justification
+# loops are JIT-compiled, otherwise the plain Python versions are used
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = None
+    njit = None
 
 # Load environment variables from .env file
+# (at import, since the settings below are read from the environment)
 dotenv.load_dotenv()
 
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
-)
+# Logging is configured in main(), so importing the module leaves the root logger alone
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logger = logging.getLogger(__name__)
 
 # Define constants
@@ -30,6 +49,12 @@ MAX_LINES_PER_IMAGE = 25  # Reduced to account for larger font size
 MAX_IMAGES = 4  # Maximum number of images to generate
 MAX_WORDS = 700  # Maximum number of words allowed
 # Padding will be calculated as 10% of image dimensions with priority to top and right
+SIDE_PADDING_RATIO = 0.1  # Left and right padding as a fraction of image width
+TOP_PADDING_RATIO = 0.22  # Top padding as a fraction of image height (header space)
+BOTTOM_PADDING_RATIO = 0.2  # Bottom padding as a fraction of image height
+# Output JPEG encoder settings: single-use uploads favor fast encoding over the smallest file
+JPEG_SAVE_OPTIONS = {'quality': 75, 'optimize': False, 'progressive': False, 'subsampling': 2}  # subsampling=2 is 4:2:0
+JIT_WRAP_MIN_WORDS = 32  # Shorter paragraphs wrap faster in plain Python than through the JIT call
 # Use the w_Aramesh fonts for Arabic/Persian characters
 FONT_PATH = "fonts/w_Aramesh Medium.ttf"  # Persian font for regular text
 FALLBACK_FONT_PATHS = [
@@ -49,19 +74,153 @@ FIRST_LINE_BOLD_FONT = "fonts/w_Aramesh Extra Bold.ttf"  # Bold font for titles
 
 # Persian/Arabic numerals mapping
 PERSIAN_DIGITS = {'0': '۰', '1': '۱', '2': '۲', '3': '۳', '4': '۴', '5': '۵', '6': '۶', '7': '۷', '8': '۸', '9': '۹'}
+PERSIAN_DIGITS_TABLE = str.maketrans(PERSIAN_DIGITS)  # Translation table for a single-pass conversion
 
 # Paragraph indentation constant
 PARAGRAPH_INDENT = "        "  # Two non-breaking spaces (NBSP: U+00A0) for paragraph indentation
 
-# Telegram Bot API URL
-API_BASE_URL = "https://api.telegram.org/bot"
+# Telegram Bot API URL; can point at a local telegram-bot-api server instead
+# (e.g. http://localhost:8081/bot) to save the round trip to api.telegram.org
+API_BASE_URL = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org/bot")
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+SEND_MESSAGE_URL = f"{API_BASE_URL}{TELEGRAM_BOT_TOKEN}/sendMessage"
+SEND_PHOTO_URL = f"{API_BASE_URL}{TELEGRAM_BOT_TOKEN}/sendPhoto"
+SEND_MEDIA_GROUP_URL = f"{API_BASE_URL}{TELEGRAM_BOT_TOKEN}/sendMediaGroup"
+GET_UPDATES_URL = f"{API_BASE_URL}{TELEGRAM_BOT_TOKEN}/getUpdates"
+SET_WEBHOOK_URL = f"{API_BASE_URL}{TELEGRAM_BOT_TOKEN}/setWebhook"
+DELETE_WEBHOOK_URL = f"{API_BASE_URL}{TELEGRAM_BOT_TOKEN}/deleteWebhook"
+
+# Long polling: Telegram holds getUpdates open for up to LONG_POLL_TIMEOUT seconds,
+# so the client read timeout must be a bit longer than that
+LONG_POLL_TIMEOUT = 30
+GET_UPDATES_TIMEOUT = (5, LONG_POLL_TIMEOUT + 5)  # (connect, read) in seconds
+ALLOWED_UPDATES = '["message", "callback_query"]'  # Only the update types handled by the bot
+GET_UPDATES_LIMIT = 100  # Largest batch Telegram returns per getUpdates call
+# Failed polls are retried after an exponentially growing, jittered delay
+POLL_RETRY_DELAY_MIN = 1  # Delay after the first failure in seconds
+POLL_RETRY_DELAY_MAX = 30  # Upper bound of the delay in seconds
+
+# Webhook mode: when WEBHOOK_URL is set, Telegram pushes updates to the bot's own
+# HTTP server instead of the bot polling getUpdates. HTTPS is expected to be
+# terminated by a reverse proxy in front of WEBHOOK_PORT.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public HTTPS URL Telegram sends updates to
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8000"))  # Local port the webhook server listens on
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Optional token Telegram echoes back in every webhook request
+WEBHOOK_MAX_CONNECTIONS = 40  # Simultaneous webhook connections Telegram may open
+# A pooled keep-alive connection can go stale silently, so sends must not wait forever
+SEND_TIMEOUT = (5, 30)  # (connect, read) in seconds
+
+# JSON request bodies are used for every call except sendPhoto (multipart upload)
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Inline keyboard for starting a new image, attached to the bot's final reply
+# (the photo, the message after an album, or an error message)
+START_KEYBOARD = {
+    "inline_keyboard": [[
+        {"text": "📝 Create New Image", "callback_data": "start"}
+    ]]
+}
+START_KEYBOARD_JSON = orjson.dumps(START_KEYBOARD).decode()  # Multipart uploads need it pre-encoded
+IMAGE_READY_CAPTION = "✅ تصویر شما آماده شد!\n\n✅ Your image is ready!\n\nبرای ساخت تصویر جدید دکمه زیر را فشار دهید:\nClick the button below to create a new image:"
+
+# Bilingual (Persian/English) replies, built once
+MSG_WELCOME = 'سلام! لطفاً ابتدا عنوان خود را وارد کنید:\n\nHello! Please enter your title first:'
+MSG_HELP = 'برای شروع /start را بفرستید. ابتدا عنوان، سپس متن را وارد کنید.\n\nSend /start to begin. Enter title first, then text.'
+MSG_ENTER_TITLE = 'لطفاً ابتدا عنوان خود را وارد کنید:\n\nPlease enter your title first:'
+MSG_TITLE_RECEIVED = 'عنوان دریافت شد! حالا لطفاً متن خود را وارد کنید:\n\nTitle received! Now please enter your text:'
+MSG_PROCESSING = "در حال پردازش متن شما..."
+MSG_IMAGE_COUNT = "متن شما در {0} تصویر قرار داده شده است.\n\nYour text has been placed on {0} images."  # Formatted with the number of images
+MSG_SEND_START_FIRST = 'لطفاً ابتدا /start را بفرستید تا فرآیند را شروع کنید.\n\nPlease send /start first to begin the process.'
+ERR_TOO_MANY_WORDS = f"متن شما بیش از حد مجاز {MAX_WORDS} کلمه است. لطفاً متن کوتاه‌تری را ارسال کنید.\n\nYour text exceeds the maximum limit of {MAX_WORDS} words. Please send a shorter text."
+ERR_TEXT_TOO_LONG = f"متن شما بسیار طولانی است. لطفاً متن کوتاه‌تری را ارسال کنید.\n\nYour text is too long. Please send a shorter text (maximum {MAX_IMAGES} images)."
+ERR_PROCESSING = "متأسفانه در پردازش متن شما مشکلی پیش آمد. لطفاً دوباره تلاش کنید.\n\nSorry, there was an error processing your text. Please try again."
+
+# Persistent HTTP session so Telegram calls reuse keep-alive connections.
+# The pool keeps a connection for every thread that may call Telegram at the
+# same time (poller, update workers and their senders), so none is discarded.
+# Failed connection attempts are retried briefly. Read errors are never
+# retried: a POST may already have reached the server, and a stalled long
+# poll is left to the polling loop's backoff instead of being repeated here.
+SESSION = requests.Session()
+SESSION_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                              max_retries=Retry(total=2, read=0, backoff_factor=0.2))
+SESSION.mount("https://", SESSION_ADAPTER)
+SESSION.mount("http://", SESSION_ADAPTER)  # A local Bot API server is usually plain HTTP
+
+# Updates are handled off the polling loop so rendering doesn't delay the next poll.
+# Different chats are handled in parallel; updates of one chat stay in arrival
+# order, which the two-step title/text input relies on.
+UPDATE_WORKERS = 4  # Number of chats whose updates can be processed at the same time
+UPDATE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix="updates")
+_pending_chat_updates = {}  # Updates waiting for an earlier update of the same chat: {chat_id: deque}
+_pending_chat_updates_lock = threading.Lock()
+
+# Background workers for Telegram calls that can overlap with image rendering
+# (each update being processed uses one for the processing notice)
+TELEGRAM_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix="telegram")
+
+# Cache of measured text widths keyed by (text, font path, font size)
+TEXT_WIDTH_CACHE_SIZE = 4096  # Maximum number of cached measurements
+_text_width_cache = {}
+
+# Encoded images of recent requests keyed by (title, text, date), so an
+# identical request is answered without rendering again (each entry holds
+# up to MAX_IMAGES JPEGs, which bounds the memory used)
+RENDERED_IMAGES_CACHE_SIZE = 32  # Maximum number of cached requests
+_rendered_images_cache = {}
+
+# Background image with the overlay applied, loaded on first use
+_background_image = None
 
 # User state management for two-step input
-user_states = {}  # Dictionary to store user states: {chat_id: {'step': 'waiting_title'|'waiting_text', 'title': str}}
+class UserState:
+    """Where a chat is in the two-step title/text input."""
+    __slots__ = ('step', 'title')
+    
+    def __init__(self):
+        self.step = None  # None, 'waiting_title' or 'waiting_text'
+        self.title = ''
+
+user_states = {}  # Dictionary to store user states: {chat_id: UserState}
+
+# Optional SQLite file the user states are mirrored to, so conversations
+# survive a restart; without it states only live in memory
+STATE_DB_PATH = os.getenv("STATE_DB_PATH")
+_state_db = None  # Open connection when STATE_DB_PATH is set, see open_state_db
+_state_db_lock = threading.Lock()  # The connection is shared by the update workers
 
+@functools.lru_cache(maxsize=2)
+def resolve_font_path(bold=False):
+    """Find the first usable font file, prioritizing Arabic/Persian support.
+    
+    The candidate paths are checked once per style, so later font loads
+    don't repeat the filesystem lookups.
+    
+    Args:
+        bold: Whether to look for the bold font first
+        
+    Returns:
+        Path to the font file, or None if no candidate could be opened
+    """
+    candidates = FALLBACK_FONT_PATHS
+    if bold:
+        candidates = [FIRST_LINE_BOLD_FONT] + FALLBACK_FONT_PATHS
+    
+    for font_path in candidates:
+        try:
+            if os.path.exists(font_path):
+                ImageFont.truetype(font_path, MIN_FONT_SIZE)
+                return font_path
+        except (IOError, OSError):
+            continue
+    return None
+
+@functools.lru_cache(maxsize=128)
 def get_font(size, bold=False):
     """Get a font with fallback options, prioritizing Arabic/Persian support.
     
+    Fonts are cached per (size, bold) so each FreeType face is created once.
+    
     Args:
         size: Font size
         bold: Whether to use bold font
@@ -69,21 +228,13 @@ def get_font(size, bold=False):
     Returns:
         Font object
     """
-    if bold:
-        # Try to load the bold font first
+    font_path = resolve_font_path(bold)
+    if font_path is not None:
         try:
-            if os.path.exists(FIRST_LINE_BOLD_FONT):
-                return ImageFont.truetype(FIRST_LINE_BOLD_FONT, size)
+            return ImageFont.truetype(font_path, size)
         except (IOError, OSError):
             pass
     
-    for font_path in FALLBACK_FONT_PATHS:
-        try:
-            if os.path.exists(font_path):
-                return ImageFont.truetype(font_path, size)
-        except (IOError, OSError):
-            continue
-    
     # If no font found, use default
     try:
         return ImageFont.load_default()
@@ -91,6 +242,36 @@ def get_font(size, bold=False):
         logger.warning(f"Using default font - Arabic/Persian text may not render correctly: {e}")
         return ImageFont.load_default()
 
+def get_text_width(text, font):
+    """Measure the rendered width of a text, reusing cached measurements.
+    
+    Words repeat a lot in the wrapping and justification passes, so each
+    (text, font) pair is measured only once. The cache is keyed by font path
+    and size so that switching font size invalidates the entries naturally.
+    
+    Args:
+        text: Text to measure
+        font: Font object for measuring text
+        
+    Returns:
+        Width of the text in pixels
+    """
+    key = (text, getattr(font, 'path', None), getattr(font, 'size', None))
+    width = _text_width_cache.get(key)
+    if width is None:
+        if len(_text_width_cache) >= TEXT_WIDTH_CACHE_SIZE:
+            _text_width_cache.clear()
+        width = font.getlength(text)
+        _text_width_cache[key] = width
+    return width
+
+def preload_fonts():
+    """Load every font size the renderer can use so the first request doesn't pay for it."""
+    for size in range(MIN_FONT_SIZE, MAX_FONT_SIZE + 1):
+        get_font(size)
+        get_font(int(size * 1.2), bold=True)  # Title font
+    get_font(DATE_FONT_SIZE)
+
 def convert_to_persian_numerals(text):
     """Convert Western numerals in text to Persian/Arabic numerals.
     
@@ -100,9 +281,7 @@ def convert_to_persian_numerals(text):
     Returns:
         String with Western numerals replaced by Persian/Arabic equivalents
     """
-    for western, persian in PERSIAN_DIGITS.items():
-        text = text.replace(western, persian)
-    return text
+    return text.translate(PERSIAN_DIGITS_TABLE)
 
 def process_arabic_text(text):
     """Process Arabic/Persian text for proper RTL display.
@@ -113,6 +292,10 @@ def process_arabic_text(text):
     Returns:
         Text processed for RTL sentence flow
     """
+    # Without a period there is only one sentence and nothing to reorder
+    if '.' not in text:
+        return text.rstrip() if text.strip() else text
+    
     try:
         # Preserve leading whitespace (indentation)
         leading_whitespace = ''
@@ -134,20 +317,47 @@ def process_arabic_text(text):
         # Restore leading whitespace (indentation)
         final_text = leading_whitespace + rtl_text
         
-        logger.info(f"RTL sentence processing: '{text}' -> '{final_text}'")
+        logger.debug("RTL sentence processing: %r -> %r", text, final_text)
         return final_text
     except Exception as e:
         logger.error(f"Error processing Arabic text: {e}")
         return text
 
-def justify_line(words, font, target_width, draw_obj):
+def reverse_sentence_order(line):
+    """Reverse the order of the sentences in a wrapped line for RTL flow.
+    
+    Args:
+        line: A single wrapped line of text
+        
+    Returns:
+        Line with its sentences in RTL display order
+    """
+    # A line without a period is a single sentence and only needs trimming
+    if '.' not in line:
+        return line.strip()
+    
+    # PROPER RTL PROCESSING: Manual sentence reversal for RTL flow
+    try:
+        # Split line into sentences and reverse their order
+        sentences = line.split('.')
+        sentences = [s.strip() for s in sentences if s.strip()]
+        reversed_sentences = sentences[::-1]
+        bidi_line = '. '.join(reversed_sentences)
+        if line.endswith('.'):
+            bidi_line += '.'
+        logger.debug("RTL sentence processing: %r -> %r", line, bidi_line)
+    except Exception as e:
+        logger.error(f"RTL processing failed: {e}")
+        bidi_line = line
+    return bidi_line
+
+def justify_line(words, font, target_width):
     """Justify a line by distributing extra spaces between words.
     
     Args:
         words: List of words in the line
         font: Font object for measuring text
         target_width: Target width for the justified line
-        draw_obj: ImageDraw object for measuring text
         
     Returns:
         Justified line as a string
@@ -156,10 +366,11 @@ def justify_line(words, font, target_width, draw_obj):
         return ' '.join(words)
     
     # Calculate the width of words without extra spaces (simplified for RTL)
-    words_width = sum(draw_obj.textlength(word, font) for word in words)
+    words_width = sum(get_text_width(word, font) for word in words)
     
     # Calculate the width of normal spaces between words
-    normal_spaces_width = (len(words) - 1) * draw_obj.textlength(' ', font)
+    space_char_width = get_text_width(' ', font)
+    normal_spaces_width = (len(words) - 1) * space_char_width
     
     # Calculate how much extra space we need to distribute
     extra_space_needed = target_width - words_width - normal_spaces_width
@@ -168,30 +379,130 @@ def justify_line(words, font, target_width, draw_obj):
         return ' '.join(words)
     
     # Calculate how many extra spaces to add between each pair of words
-    space_char_width = draw_obj.textlength(' ', font)
     if space_char_width > 0:
-        extra_spaces_total = int(extra_space_needed / space_char_width)
         gaps = len(words) - 1
         
         if gaps > 0:
             # Distribute extra spaces as evenly as possible
-            extra_spaces_per_gap = extra_spaces_total // gaps
-            extra_spaces_remainder = extra_spaces_total % gaps
+            extra_spaces_per_gap, extra_spaces_remainder = justify_space_counts(
+                words_width, gaps, space_char_width, target_width
+            )
             
-            justified_words = [words[0]]
-            for i in range(1, len(words)):
-                # Add normal space plus extra spaces
-                spaces = ' ' * (1 + extra_spaces_per_gap)
-                # Add one more space to the first few gaps to distribute remainder
-                if i <= extra_spaces_remainder:
-                    spaces += ' '
-                justified_words.append(spaces + words[i])
+            # Normal space plus extra spaces, built once for all gaps
+            base_spaces = ' ' * (1 + extra_spaces_per_gap)
+            # The first few gaps get one more space to distribute the remainder
+            wide_spaces = base_spaces + ' '
             
-            return ''.join(justified_words)
+            return ''.join([words[0]] + [
+                (wide_spaces if i <= extra_spaces_remainder else base_spaces) + words[i]
+                for i in range(1, len(words))
+            ])
     
     # Fallback to normal spacing if calculation fails
     return ' '.join(words)
 
+def justify_space_counts(words_width, gaps, space_width, target_width):
+    """Calculate how many extra spaces to insert into each gap of a justified line.
+    
+    Args:
+        words_width: Total width of the words in the line
+        gaps: Number of gaps between words
+        space_width: Width of a single space
+        target_width: Target width for the justified line
+        
+    Returns:
+        Tuple of (extra spaces per gap, number of leading gaps that get one more)
+    """
+    extra_space_needed = target_width - words_width - gaps * space_width
+    if extra_space_needed <= 0 or space_width <= 0 or gaps <= 0:
+        return 0, 0
+    extra_spaces_total = int(extra_space_needed / space_width)
+    return extra_spaces_total // gaps, extra_spaces_total % gaps
+
+def wrap_line_ends(widths, space_width, max_width):
+    """Find where each line ends when wrapping words of the given widths.
+    
+    Uses prefix sums of the word widths (each followed by a space) so that the
+    end of every line is found with a single bisect instead of re-measuring
+    the growing line for each word.
+    
+    Args:
+        widths: Width of each word
+        space_width: Width of a single space
+        max_width: Maximum width of a line in pixels
+        
+    Returns:
+        List with the exclusive end index of every line
+    """
+    prefix_widths = [0]
+    for word_width in widths:
+        prefix_widths.append(prefix_widths[-1] + word_width + space_width)
+    
+    line_ends = []
+    start = 0
+    while start < len(widths):
+        # Last word index whose line (without its trailing space) still fits
+        end = bisect.bisect_right(prefix_widths, prefix_widths[start] + max_width + space_width) - 1
+        # A single word wider than the line still gets a line of its own
+        end = max(end, start + 1)
+        line_ends.append(end)
+        start = end
+    return line_ends
+
+if njit is not None:
+    justify_space_counts = njit(cache=True)(justify_space_counts)
+    
+    @njit(cache=True)
+    def _wrap_line_ends_jit(widths, space_width, max_width):
+        """JIT-compiled equivalent of wrap_line_ends working on a NumPy array."""
+        # Accumulated exactly like wrap_line_ends, so both find the same breaks
+        prefix_widths = np.zeros(len(widths) + 1)
+        for i in range(len(widths)):
+            prefix_widths[i + 1] = prefix_widths[i] + widths[i] + space_width
+        
+        line_ends = np.empty(len(widths), dtype=np.int32)
+        line_count = 0
+        start = 0
+        while start < len(widths):
+            end = np.searchsorted(prefix_widths, prefix_widths[start] + max_width + space_width, side='right') - 1
+            if end < start + 1:
+                end = start + 1
+            line_ends[line_count] = end
+            line_count += 1
+            start = end
+        return line_ends[:line_count]
+
+def break_words_into_lines(words, font, max_width):
+    """Break a list of words into lines that fit within the given width.
+    
+    Sentence reordering for RTL display does not change the width of a line,
+    so the logical words are measured as-is.
+    
+    Args:
+        words: List of words to wrap
+        font: Font object for measuring text
+        max_width: Maximum width of a line in pixels
+        
+    Returns:
+        List of lines, each line being a list of words
+    """
+    space_width = get_text_width(' ', font)
+    # Words repeat a lot, so look each distinct word up only once
+    word_widths = {word: get_text_width(word, font) for word in set(words)}
+    widths = [word_widths[word] for word in words]
+    
+    if njit is not None and len(widths) >= JIT_WRAP_MIN_WORDS:
+        line_ends = _wrap_line_ends_jit(np.array(widths, dtype=np.float64), space_width, max_width)
+    else:
+        line_ends = wrap_line_ends(widths, space_width, max_width)
+    
+    lines = []
+    start = 0
+    for end in line_ends:
+        lines.append(words[start:end])
+        start = end
+    return lines
+
 def parse_title_and_text(input_text: str) -> tuple:
     """Parse input text to separate title from body text.
     
@@ -232,76 +543,126 @@ def add_paragraph_indentation(text: str) -> str:
     
     # Split text into paragraphs by double newlines (actual paragraph separators)
     paragraphs = text.split('\n\n')
-    indented_paragraphs = []
     
     for i, paragraph in enumerate(paragraphs):
-        if paragraph.strip():  # Only indent non-empty paragraphs
-            # Preserve existing leading whitespace and add half-space + 4 spaces
-            lines = paragraph.split('\n')
-            if lines:
-                # Add indentation to the first line of the paragraph only
-                first_line = lines[0]
-                # Preserve any existing leading whitespace
-                leading_whitespace = ''
-                stripped_first_line = first_line.lstrip()
-                if len(first_line) > len(stripped_first_line):
-                    leading_whitespace = first_line[:len(first_line) - len(stripped_first_line)]
-                
-                # Add half-space (ZWNJ: U+200C) + 4 spaces for RTL indentation
-                indented_first_line = leading_whitespace + "\u200C    " + stripped_first_line
-                lines[0] = indented_first_line
-                
-                indented_paragraph = '\n'.join(lines)
-                indented_paragraphs.append(indented_paragraph)
-            else:
-                indented_paragraphs.append(paragraph)
-        else:
-            # Preserve empty paragraphs as-is
-            indented_paragraphs.append(paragraph)
+        if paragraph.strip():  # Only indent non-empty paragraphs; empty ones are kept as-is
+            # Add indentation to the first line of the paragraph only,
+            # after any existing leading whitespace
+            first_line, newline, rest = paragraph.partition('\n')
+            stripped_first_line = first_line.lstrip()
+            leading_whitespace = first_line[:len(first_line) - len(stripped_first_line)]
+            
+            # Add half-space (ZWNJ: U+200C) + 4 spaces for RTL indentation
+            paragraphs[i] = leading_whitespace + "\u200C    " + stripped_first_line + newline + rest
     
     # Merge paragraphs back together with double newlines
-    return '\n\n'.join(indented_paragraphs)
+    return '\n\n'.join(paragraphs)
+
+def get_background_image():
+    """Get the background image with the readability overlay already applied.
+    
+    The background never changes, so it is decoded and composited once and
+    then reused by every request. Callers must copy it before drawing on it.
+    
+    Returns:
+        RGB Image object, or None if the background image is missing
+    """
+    global _background_image
+    if _background_image is not None:
+        return _background_image
+    
+    # Use only image_1.jpg as the background image
+    background_image_path = os.path.join(IMAGE_FOLDER, "image_1.jpg")
+    if not os.path.exists(background_image_path):
+        logger.error("Background image not found: image_1.jpg")
+        return None
+    
+    # Open the background image and decode it right away
+    try:
+        bg_img = Image.open(background_image_path)
+        bg_img.load()
+        logger.info(f"Using background image: {background_image_path} with dimensions {bg_img.size[0]}x{bg_img.size[1]}")
+    except Exception as e:
+        logger.error(f"Error opening background image: {e}")
+        # Fallback to a plain white background with fallback dimensions
+        bg_img = Image.new('RGB', (800, 600), color=(255, 255, 255))
+    
+    # Add a very light semi-transparent white overlay to improve text readability.
+    # The background is opaque, so this is a plain linear blend towards white on RGB,
+    # applied through a lookup table instead of a full-size overlay image.
+    overlay_alpha = 30 / 255  # White with alpha=30 (much lighter)
+    lighten = [round(value + (255 - value) * overlay_alpha) for value in range(256)]  # Rounded like alpha_composite
+    _background_image = bg_img.convert('RGB').point(lighten * 3)
+    return _background_image
+
+def count_min_text_lines(title, text):
+    """Count the lines the layout of a title and text needs at the very least.
+    
+    Every line of the body becomes at least one rendered line (an empty one
+    included), and a title takes at least one line plus the empty line after
+    it, whatever the font size.
+    
+    Args:
+        title: The title text
+        text: The body text
+        
+    Returns:
+        Minimum number of rendered lines
+    """
+    # Same split into title and body as create_text_image
+    full_text = title
+    if text:
+        full_text += '\n\n' + text
+    title_part, body_part = parse_title_and_text(full_text)
+    
+    line_count = 2 if title_part else 0
+    if body_part:
+        line_count += body_part.count('\n') + 1
+    return line_count
+
+@functools.lru_cache(maxsize=1)
+def get_max_text_lines():
+    """Get the number of lines that MAX_IMAGES images hold at MIN_FONT_SIZE.
+    
+    No line is shorter than a body line at the minimum font size, so a text
+    that needs more lines than this (see count_min_text_lines) can never fit
+    and can be rejected without laying it out.
+    
+    Returns:
+        Maximum number of lines, or None if it can't be determined
+    """
+    base_img = get_background_image()
+    if base_img is None:
+        return None
+    height = base_img.size[1]
+    
+    # Same text area and fitting rule as create_text_image
+    max_text_height_per_image = height - (int(height * TOP_PADDING_RATIO) + int(height * BOTTOM_PADDING_RATIO))
+    return MAX_IMAGES * max_text_height_per_image // int(MIN_FONT_SIZE * 1.5)
 
 def create_text_image(title: str, text: str) -> list:
-    """Create image(s) with the given title and text and return the path(s) to the image(s).
+    """Create image(s) with the given title and text and return them as in-memory JPEG files.
     
     Args:
         title: The title text
         text: The body text
         
     Returns:
-        List of paths to generated images or empty list if error
+        List of (file name, BytesIO) tuples for the generated images or empty list if error
     """
-    # Body text will be processed for indentation later in get_wrapped_text_and_height
+    # Body text is indented into paragraphs below, before wrapping
     body_text = text
     
     # Combine title and body for processing
     full_text = title
     if body_text:
         full_text += '\n\n' + body_text
-    # Reshape Arabic/Persian text
-    reshaped_text = arabic_reshaper.reshape(full_text)
-    bidi_text = get_display(reshaped_text)
     
-    # Use only image_1.jpg as the background image
-    background_image_path = os.path.join(IMAGE_FOLDER, "image_1.jpg")
-    if not os.path.exists(background_image_path):
-        logger.error("Background image not found: image_1.jpg")
+    # Get the prepared background image and its original dimensions
+    base_img = get_background_image()
+    if base_img is None:
         return []
-    
-    # Open the background image and get its original dimensions
-    try:
-        bg_img = Image.open(background_image_path)
-        width, height = bg_img.size
-        logger.info(f"Using background image: {background_image_path} with dimensions {width}x{height}")
-    except Exception as e:
-        logger.error(f"Error opening background image: {e}")
-        # Fallback dimensions
-        width, height = 800, 600
-    
-    # Create a temporary image for text measurement
-    temp_img = Image.new('RGB', (width, height), color=(255, 255, 255))
-    draw = ImageDraw.Draw(temp_img)
+    width, height = base_img.size
     
     # Adjust font size based on text length
     text_length = len(full_text)
@@ -315,103 +676,65 @@ def create_text_image(title: str, text: str) -> list:
         # For longer text, use smaller font
         font_size = MIN_FONT_SIZE  # 10pt for longer texts
     
-    font = get_font(font_size)
-    
     # Calculate padding as 0.1 of image dimensions
-    right_padding = int(width * 0.1)  # 0.1 of width for right padding
-    left_padding = int(width * 0.1)  # 0.1 of width for left padding
-    top_padding = int(height * 0.22)  # Keep top padding for header space
-    bottom_padding = int(height * 0.2)  # Keep bottom padding
+    right_padding = int(width * SIDE_PADDING_RATIO)  # 0.1 of width for right padding
+    left_padding = int(width * SIDE_PADDING_RATIO)  # 0.1 of width for left padding
+    top_padding = int(height * TOP_PADDING_RATIO)  # Keep top padding for header space
+    bottom_padding = int(height * BOTTOM_PADDING_RATIO)  # Keep bottom padding
     
     # Calculate text width and height for wrapping
     max_text_width = width - (right_padding + left_padding)
     
+    # Parse title and body and split them into words once; only the wrapping
+    # depends on the font size, so this isn't repeated for every size tried
+    title_part, body_part = parse_title_and_text(full_text)
+    title_words = title_part.split() if title_part else None  # None when there is no title
+    paragraph_words = []  # Words of each body line, None for empty lines
+    if body_part:
+        # Apply paragraph indentation first, then split by newlines to preserve intentional line breaks
+        for paragraph in add_paragraph_indentation(body_part).split('\n'):
+            paragraph_words.append(paragraph.split(' ') if paragraph.strip() else None)
+    
     # Function to wrap text and calculate total height with justification and preserved whitespace
-    def get_wrapped_text_and_height(text, font, title_font, max_width):
+    def get_wrapped_text_and_height(title_words, paragraph_words, font, title_font, max_width):
         lines = []
         line_info = []  # Store additional info about each line for justification
         
-        # Parse title and body from combined text
-        title_part, body_part = parse_title_and_text(text)
-        
         # Process title first if it exists
-        if title_part:
+        if title_words is not None:
             # Handle title wrapping - use 0.7 of background width
             title_max_width = int(width * 0.7)  # 0.7 of background width
-            title_words = title_part.split()
-            current_title_line = []
-            
-            for word in title_words:
-                # Test if adding this word would exceed 0.7 of background width
-                test_line = ' '.join(current_title_line + [word])
-                test_width = draw.textlength(test_line, title_font)
-                
-                if test_width <= title_max_width or not current_title_line:
-                    current_title_line.append(word)
-                else:
-                    # Add current line and start new one
-                    lines.append(' '.join(current_title_line))
-                    line_info.append({'is_empty': False, 'is_title': True, 'is_last_in_paragraph': False, 'words': current_title_line.copy()})
-                    current_title_line = [word]
+            title_lines = break_words_into_lines(title_words, title_font, title_max_width)
             
-            # Add the last title line
-            if current_title_line:
-                lines.append(' '.join(current_title_line))
-                line_info.append({'is_empty': False, 'is_title': True, 'is_last_in_paragraph': True, 'words': current_title_line.copy()})
+            for line_idx, title_line_words in enumerate(title_lines):
+                lines.append(' '.join(title_line_words))
+                line_info.append({'is_empty': False, 'is_title': True, 'is_last_in_paragraph': line_idx == len(title_lines) - 1, 'words': title_line_words})
             
             # Add empty line after title
             lines.append('')
             line_info.append({'is_empty': True, 'is_title': False, 'is_last_in_paragraph': True})
         
         # Process body text if it exists
-        if body_part:
-            # Apply paragraph indentation first
-            body_part = add_paragraph_indentation(body_part)
-            # Split by newlines first to preserve intentional line breaks
-            paragraphs = body_part.split('\n')
-        
-            for paragraph_idx, paragraph in enumerate(paragraphs):
-                if not paragraph.strip():  # Preserve empty lines
-                    lines.append('')
-                    line_info.append({'is_empty': True, 'is_title': False, 'is_last_in_paragraph': True})
-                    continue
-                    
-                words = paragraph.split(' ')
-                current_line_words = [words[0]] if words else []
-                
-                for word in words[1:]:
-                    # Try adding the word to the current line
-                    test_line = ' '.join(current_line_words + [word])
-                    # For RTL text, we need to measure each line with proper Arabic processing
-                    processed_test_line = process_arabic_text(test_line)
-                    test_width = draw.textlength(processed_test_line, font)
-                    
-                    if test_width <= max_width:
-                        current_line_words.append(word)
-                    else:
-                        # Add the current line to lines
-                        lines.append(' '.join(current_line_words))
-                        line_info.append({
-                            'is_empty': False,
-                            'is_title': False,
-                            'is_last_in_paragraph': False,
-                            'words': current_line_words.copy()
-                        })
-                        current_line_words = [word]
-                
-                # Add the last line of this paragraph
-                if current_line_words:
-                    lines.append(' '.join(current_line_words))
-                    line_info.append({
-                        'is_empty': False,
-                        'is_title': False,
-                        'is_last_in_paragraph': True,
-                        'words': current_line_words.copy()
-                    })
+        for words in paragraph_words:
+            if words is None:  # Preserve empty lines
+                lines.append('')
+                line_info.append({'is_empty': True, 'is_title': False, 'is_last_in_paragraph': True})
+                continue
+            
+            paragraph_lines = break_words_into_lines(words, font, max_width)
+            
+            for line_idx, line_words in enumerate(paragraph_lines):
+                lines.append(' '.join(line_words))
+                line_info.append({
+                    'is_empty': False,
+                    'is_title': False,
+                    'is_last_in_paragraph': line_idx == len(paragraph_lines) - 1,
+                    'words': line_words
+                })
         
         # Calculate line height and total text height
         line_height = int(font.size * 1.5)  # Add some spacing between lines
-        title_line_height = int(title_font.size * 1.5) if title_part else line_height
+        title_line_height = int(title_font.size * 1.5) if title_words is not None else line_height
         
         # Calculate total height considering title uses different line height
         total_text_height = 0
@@ -423,35 +746,65 @@ def create_text_image(title: str, text: str) -> list:
         
         return lines, total_text_height, line_height, line_info
     
-    # Find optimal font size
-    wrapped_lines = []
-    while font_size > MIN_FONT_SIZE:
-        font = get_font(font_size)
-        title_font_size = int(font_size * 1.2)  # Title is 1.2x the body font size
-        title_font = get_font(title_font_size, bold=True)
-        wrapped_lines, total_text_height, line_height, line_info = get_wrapped_text_and_height(full_text, font, title_font, max_text_width)
-        
-        # Check if text can fit in MAX_IMAGES images
-        max_text_height_per_image = height - (top_padding + bottom_padding)  # Use height with calculated padding
-        total_images_needed = (total_text_height + max_text_height_per_image - 1) // max_text_height_per_image
-        
-        if total_images_needed <= MAX_IMAGES:
-            break
+    # Space available for text on each image
+    max_text_height_per_image = height - (top_padding + bottom_padding)  # Use height with calculated padding
+    
+    def wrap_at_size(size):
+        """Wrap the text at the given body font size and count the images it needs."""
+        size_font = get_font(size)
+        size_title_font = get_font(int(size * 1.2), bold=True)  # Title is 1.2x the body font size
+        wrapped = get_wrapped_text_and_height(title_words, paragraph_words, size_font, size_title_font, max_text_width)
+        images_needed = (wrapped[1] + max_text_height_per_image - 1) // max_text_height_per_image
+        return size_font, wrapped, images_needed
+    
+    # Find optimal font size: wrap once at the starting size and, if the text
+    # doesn't fit in MAX_IMAGES images, estimate the size it needs instead of
+    # shrinking one point at a time. Both the number of lines and the line
+    # height scale with the font size, so the text height grows with its square.
+    font, wrapped, total_images_needed = wrap_at_size(font_size)
+    if total_images_needed > MAX_IMAGES and font_size > MIN_FONT_SIZE:
+        largest_size = font_size - 1
+        available_height = MAX_IMAGES * max_text_height_per_image
+        estimated_size = int(font_size * math.sqrt(available_height / wrapped[1]))
+        font_size = max(MIN_FONT_SIZE, min(largest_size, estimated_size))
+        font, wrapped, total_images_needed = wrap_at_size(font_size)
         
-        font_size -= 1  # Decrease by 1 for finer control
+        # Correct the estimate: shrink while it overshoots, grow while a larger size still fits.
+        # A smaller font never needs more lines, so scaling the size by the height
+        # ratio lands at or below the largest size that fits.
+        while total_images_needed > MAX_IMAGES and font_size > MIN_FONT_SIZE:
+            shrunk_size = int(font_size * available_height / wrapped[1])
+            font_size = max(MIN_FONT_SIZE, min(font_size - 1, shrunk_size))
+            font, wrapped, total_images_needed = wrap_at_size(font_size)
+        while total_images_needed <= MAX_IMAGES and font_size < largest_size:
+            candidate = wrap_at_size(font_size + 1)
+            if candidate[2] > MAX_IMAGES:
+                break
+            font_size += 1
+            font, wrapped, total_images_needed = candidate
+    
+    wrapped_lines, total_text_height, line_height, line_info = wrapped
     
     # If even with minimum font size, text doesn't fit in MAX_IMAGES images, return error
-    if font_size <= MIN_FONT_SIZE:
-        font = get_font(MIN_FONT_SIZE)
-        title_font_size = int(MIN_FONT_SIZE * 1.2)
-        title_font = get_font(title_font_size, bold=True)
-        wrapped_lines, total_text_height, line_height, line_info = get_wrapped_text_and_height(full_text, font, title_font, max_text_width)
-        max_text_height_per_image = height - (top_padding + bottom_padding)
-        total_images_needed = (total_text_height + max_text_height_per_image - 1) // max_text_height_per_image
-        
-        if total_images_needed > MAX_IMAGES:
-            logger.warning(f"Text too long to fit in {MAX_IMAGES} images even with minimum font size.")
-            return []
+    if total_images_needed > MAX_IMAGES:
+        logger.warning(f"Text too long to fit in {MAX_IMAGES} images even with minimum font size.")
+        return []
+    
+    # Prepare the RTL display text of each line once, now that the layout is final
+    # (doing it while wrapping would repeat it for every font size tried)
+    for line, current_line_info in zip(wrapped_lines, line_info):
+        if line:
+            bidi_line = reverse_sentence_order(line)
+            current_line_info['bidi'] = bidi_line
+            # Body lines that don't end a paragraph are justified across the full width
+            current_line_info['justified'] = (not current_line_info['is_title'] and
+                                              not current_line_info['is_last_in_paragraph'] and
+                                              len(current_line_info['words']) > 1)
+            if current_line_info['justified']:
+                # Words for justification, without the paragraph indentation marker
+                if bidi_line.startswith('\u200C    '):
+                    bidi_line = bidi_line[5:]
+                current_line_info['words_bidi'] = bidi_line.split()
     
     # Calculate how many lines can fit in each image
     max_lines_per_image = (height - (top_padding + bottom_padding)) // line_height
@@ -465,20 +818,21 @@ def create_text_image(title: str, text: str) -> list:
     if len(image_lines) > MAX_IMAGES:
         image_lines = image_lines[:MAX_IMAGES]
     
-    output_paths = []
+    images = []  # (file name, BytesIO) tuple of every encoded image
+    
+    # Prepare the Jalali date once; it is the same on every image
+    now = jdatetime.date.today()
+    today = convert_to_persian_numerals(f"{now.year:04d}/{now.month:02d}/{now.day:02d}")  # Persian numerals
+    date_font = get_font(DATE_FONT_SIZE)
+    date_text = process_arabic_text(today)
+    
+    # Title font (1.2x size, bold), resolved once for every title line
+    title_font = get_font(int(font.size * 1.2), bold=True)
     
     # Create each image
     for img_index, current_lines in enumerate(image_lines):
-        # Create a copy of the background image for each output image
-        img = bg_img.copy()
-        
-        # Create an RGBA version for the semi-transparent overlay
-        if img.mode != 'RGBA':
-            img = img.convert('RGBA')
-            
-        # Add a very light semi-transparent white overlay to improve text readability
-        overlay = Image.new('RGBA', img.size, (255, 255, 255, 30))  # White with alpha=30 (much lighter)
-        img = Image.alpha_composite(img, overlay)
+        # Create a copy of the prepared background for each output image
+        img = base_img.copy()
         
         # Calculate text block height
         text_block_height = len(current_lines) * line_height
@@ -490,11 +844,6 @@ def create_text_image(title: str, text: str) -> list:
         img_draw = ImageDraw.Draw(img)
         
         # Add Jalali date to top left corner with Persian numerals
-        today = jdatetime.datetime.now().strftime("%Y/%m/%d")
-        today = convert_to_persian_numerals(today)  # Convert to Persian numerals
-        date_font = get_font(DATE_FONT_SIZE)
-        date_text = process_arabic_text(today)
-        date_width = img_draw.textlength(date_text, font=date_font)
         img_draw.text((left_padding, int(top_padding * 0.5)), date_text, font=date_font, fill=(0, 0, 0))
         
         # Draw each line of text justified within the padding
@@ -515,30 +864,20 @@ def create_text_image(title: str, text: str) -> list:
             # Get line info for justification
             current_line_info = line_info[global_line_idx] if global_line_idx < len(line_info) else {'is_empty': False, 'is_last_in_paragraph': True, 'words': line.split()}
             
-            # PROPER RTL PROCESSING: Manual sentence reversal for RTL flow
-            try:
-                # Split line into sentences and reverse their order
-                sentences = line.split('.')
-                sentences = [s.strip() for s in sentences if s.strip()]
-                reversed_sentences = sentences[::-1]
-                bidi_line = '. '.join(reversed_sentences)
-                if line.endswith('.'):
-                    bidi_line += '.'
-                logger.info(f"RTL sentence processing: '{line}' -> '{bidi_line}'")
-            except Exception as e:
-                logger.error(f"RTL processing failed: {e}")
-                bidi_line = line
+            # Use the RTL display text prepared once for the final layout
+            bidi_line = current_line_info['bidi'] if 'bidi' in current_line_info else reverse_sentence_order(line)
             
             # Check if this line is a title
             if current_line_info.get('is_title', False):
-                # Use title font (1.2x size, bold)
-                title_font_size = int(font.size * 1.2)
-                current_font = get_font(title_font_size, bold=True)
+                current_font = title_font
             else:
                 current_font = font
             
+            # Justified body lines span the full width, so only the other lines need measuring
+            is_justified = current_line_info.get('justified', False)
+            
             # Handle positioning based on line type
-            line_width = img_draw.textlength(bidi_line, font=current_font)
+            line_width = 0 if is_justified else get_text_width(bidi_line, current_font)
             
             if current_line_info.get('is_title', False):
                 # Title: always center-aligned, bold, font size 1.2x, with proper padding
@@ -572,22 +911,22 @@ def create_text_image(title: str, text: str) -> list:
                 # Calculate RTL indentation width using half-space + 4 spaces
                 indent_width = 0
                 if is_first_line_of_paragraph:
-                    indent_width = img_draw.textlength('\u200C    ', current_font)  # half-space + 4 spaces width
+                    indent_width = get_text_width('\u200C    ', current_font)  # half-space + 4 spaces width
                     # Remove the indentation marker from the text for display
                     if bidi_line.startswith('\u200C    '):
                         bidi_line = bidi_line[5:]  # Remove half-space + 4 spaces
-                    logger.info(f"RTL indentation applied: line {global_line_idx}, indent_width={indent_width}px")
+                    logger.debug("RTL indentation applied: line %d, indent_width=%spx", global_line_idx, indent_width)
                 
                 # Body text: apply justification for non-last lines in paragraphs
-                if not current_line_info.get('is_last_in_paragraph', True) and len(current_line_info.get('words', [])) > 1:
+                if is_justified:
                     # Adjust justified width to account for RTL indentation
                     justified_width = width - left_padding - right_padding
                     if is_first_line_of_paragraph:
                         justified_width -= indent_width  # Reduce width for indented lines
                     
-                    words = bidi_line.split()
+                    words = current_line_info.get('words_bidi') or bidi_line.split()
                     if len(words) > 1:
-                        bidi_line = justify_line(words, current_font, justified_width, img_draw)
+                        bidi_line = justify_line(words, current_font, justified_width)
                     # Justified text starts from left padding
                     x_position = left_padding
                 else:
@@ -602,7 +941,7 @@ def create_text_image(title: str, text: str) -> list:
                         x_position -= indent_width
                         if x_position < left_padding:
                             x_position = left_padding
-                        logger.info(f"RTL indentation positioning: x_pos {original_x} -> {x_position} (indent={indent_width}px)")
+                        logger.debug("RTL indentation positioning: x_pos %s -> %s (indent=%spx)", original_x, x_position, indent_width)
             
             img_draw.text((x_position, current_y), bidi_line, font=current_font, fill=(0, 0, 0))
             
@@ -612,62 +951,126 @@ def create_text_image(title: str, text: str) -> list:
             else:
                 current_y += line_height
         
-        # Save this image
-        output_path = f"output_{img_index+1}.jpg" if len(image_lines) > 1 else "output.jpg"
-        # Convert RGBA to RGB before saving as JPEG
-        if img.mode == 'RGBA':
-            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-            rgb_img.paste(img, mask=img.split()[3])  # Use alpha channel as mask
-            rgb_img.save(output_path)
-        else:
-            img.save(output_path)
-        output_paths.append(output_path)
-        logger.info(f"Saved image {img_index+1} to {output_path}")
-    
-    return output_paths
-
-def send_message(chat_id, text):
-    """Send a text message to a chat."""
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    url = f"{API_BASE_URL}{token}/sendMessage"
+        # Encode this image in memory instead of writing it to disk
+        output_name = f"output_{img_index+1}.jpg" if len(image_lines) > 1 else "output.jpg"
+        output_buffer = io.BytesIO()
+        img.save(output_buffer, format='JPEG', **JPEG_SAVE_OPTIONS)
+        output_buffer.seek(0)
+        logger.info(f"Encoded image {img_index+1} as {output_name}")
+        images.append((output_name, output_buffer))
+    
+    return images
+
+def get_text_images(title: str, text: str) -> list:
+    """Get the image(s) for the given title and text, reusing a recent identical render.
+    
+    The images show today's date, so cached renders are only reused on the
+    day they were made.
+    
+    Args:
+        title: The title text
+        text: The body text
+        
+    Returns:
+        List of (file name, BytesIO) tuples, as returned by create_text_image
+    """
+    key = (title, text, jdatetime.date.today())
+    cached_images = _rendered_images_cache.get(key)
+    if cached_images is not None:
+        return [(name, io.BytesIO(data)) for name, data in cached_images]
+    
+    images = create_text_image(title, text)
+    if images:
+        if len(_rendered_images_cache) >= RENDERED_IMAGES_CACHE_SIZE:
+            _rendered_images_cache.clear()
+        _rendered_images_cache[key] = [(name, buffer.getvalue()) for name, buffer in images]
+    return images
+
+def post_json(url, payload):
+    """Send a JSON payload to the Telegram Bot API and return the decoded response."""
+    response = SESSION.post(url, data=orjson.dumps(payload), headers=JSON_HEADERS, timeout=SEND_TIMEOUT)
+    return orjson.loads(response.content)
+
+def send_message(chat_id, text, reply_markup=None):
+    """Send a text message to a chat, optionally with a reply markup (keyboard)."""
     data = {
         "chat_id": chat_id,
         "text": text
     }
-    response = requests.post(url, data=data)
-    return response.json()
-
-def send_photo(chat_id, photo_path):
-    """Send a photo to a chat."""
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    url = f"{API_BASE_URL}{token}/sendPhoto"
-    
-    with open(photo_path, 'rb') as photo_file:
-        files = {'photo': photo_file}
-        data = {'chat_id': chat_id}
-        response = requests.post(url, data=data, files=files)
-    
-    return response.json()
-
-def send_start_button(chat_id):
-    """Send a message with start button for creating new images."""
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    url = f"{API_BASE_URL}{token}/sendMessage"
-    
-    keyboard = {
-        "inline_keyboard": [[
-            {"text": "📝 Create New Image", "callback_data": "start"}
-        ]]
-    }
+    if reply_markup is not None:
+        data["reply_markup"] = reply_markup
+    return post_json(SEND_MESSAGE_URL, data)
+
+def send_photo(chat_id, photo, caption=None, reply_markup=None):
+    """Send a photo to a chat.
     
-    data = {
-        "chat_id": chat_id,
-        "text": "✅ تصویر شما آماده شد!\n\n✅ Your image is ready!\n\nبرای ساخت تصویر جدید دکمه زیر را فشار دهید:\nClick the button below to create a new image:",
-        "reply_markup": keyboard
-    }
+    The photo is a (file name, BytesIO) tuple as returned by create_text_image,
+    uploaded straight from memory. The reply markup, if given, must already be
+    JSON-encoded since it is sent as a multipart form field.
+    """
+    data = {'chat_id': chat_id}
+    if caption is not None:
+        data['caption'] = caption
+    if reply_markup is not None:
+        data['reply_markup'] = reply_markup
+    photo_name, photo_buffer = photo
+    files = {'photo': (photo_name, photo_buffer, 'image/jpeg')}
+    response = SESSION.post(SEND_PHOTO_URL, data=data, files=files, timeout=SEND_TIMEOUT)
+    return orjson.loads(response.content)
+
+def send_media_group(chat_id, photos, caption=None):
+    """Send several photos to a chat as one album in a single request.
     
-    response = requests.post(url, data=data)
-    return response.json()
+    The photos are (file name, BytesIO) tuples as returned by create_text_image;
+    Telegram accepts 2 to 10 of them (MAX_IMAGES stays within that). The
+    caption is shown under the album. Albums can't carry a reply markup.
+    """
+    media = []
+    files = {}
+    for photo_index, (photo_name, photo_buffer) in enumerate(photos):
+        attach_name = f"photo{photo_index}"
+        media_item = {'type': 'photo', 'media': f"attach://{attach_name}"}
+        if caption is not None and photo_index == 0:
+            media_item['caption'] = caption  # The caption of the first item is the album's
+        media.append(media_item)
+        files[attach_name] = (photo_name, photo_buffer, 'image/jpeg')
+    data = {'chat_id': chat_id, 'media': orjson.dumps(media).decode()}
+    response = SESSION.post(SEND_MEDIA_GROUP_URL, data=data, files=files, timeout=SEND_TIMEOUT)
+    return orjson.loads(response.content)
+
+def get_user_state(chat_id):
+    """Get the state of a chat, creating it on first use."""
+    user_state = user_states.get(chat_id)
+    if user_state is None:
+        user_state = user_states[chat_id] = UserState()
+    return user_state
+
+def open_state_db(path):
+    """Open the user state database and load the states saved in it.
+    
+    Args:
+        path: Path of the SQLite file, created (with its directory) if missing
+    """
+    global _state_db
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")  # Cheap commits, readers don't block the writer
+    connection.execute("CREATE TABLE IF NOT EXISTS user_states (chat_id INTEGER PRIMARY KEY, step TEXT, title TEXT NOT NULL)")
+    for chat_id, step, title in connection.execute("SELECT chat_id, step, title FROM user_states"):
+        user_state = user_states[chat_id] = UserState()
+        user_state.step = step
+        user_state.title = title
+    _state_db = connection
+    logger.info(f"Loaded {len(user_states)} user states from {path}")
+
+def save_user_state(chat_id, user_state):
+    """Write a chat's state to the state database, if one is open."""
+    if _state_db is None:
+        return
+    with _state_db_lock:
+        with _state_db:  # Commits the transaction
+            _state_db.execute("INSERT OR REPLACE INTO user_states (chat_id, step, title) VALUES (?, ?, ?)",
+                              (chat_id, user_state.step, user_state.title))
 
 def handle_message(message):
     """Process incoming message and respond appropriately."""
@@ -678,84 +1081,199 @@ def handle_message(message):
     if text.startswith('/'):
         if text == '/start':
             # Reset user state and ask for title
-            user_states[chat_id] = {'step': 'waiting_title'}
-            send_message(chat_id, 'سلام! لطفاً ابتدا عنوان خود را وارد کنید:\n\nHello! Please enter your title first:')
+            user_state = get_user_state(chat_id)
+            user_state.step = 'waiting_title'
+            user_state.title = ''
+            save_user_state(chat_id, user_state)
+            send_message(chat_id, MSG_WELCOME)
         elif text == '/help':
-            send_message(chat_id, 'برای شروع /start را بفرستید. ابتدا عنوان، سپس متن را وارد کنید.\n\nSend /start to begin. Enter title first, then text.')
+            send_message(chat_id, MSG_HELP)
         return
     
-    # Get user state
-    user_state = user_states.get(chat_id, {})
-    current_step = user_state.get('step')
+    # Get user state (chats that never sent /start have none)
+    user_state = user_states.get(chat_id)
+    current_step = user_state.step if user_state is not None else None
     
     if current_step == 'waiting_title':
         # User is sending the title
-        user_states[chat_id] = {'step': 'waiting_text', 'title': text}
-        send_message(chat_id, 'عنوان دریافت شد! حالا لطفاً متن خود را وارد کنید:\n\nTitle received! Now please enter your text:')
+        user_state.step = 'waiting_text'
+        user_state.title = text
+        save_user_state(chat_id, user_state)
+        send_message(chat_id, MSG_TITLE_RECEIVED)
         return
     
     elif current_step == 'waiting_text':
         # User is sending the text
-        title = user_state.get('title', '')
+        title = user_state.title
         
         # Check word count limit for the text (not including title)
         word_count = len(text.split())
         if word_count > MAX_WORDS:
-            send_message(chat_id, f"متن شما بیش از حد مجاز {MAX_WORDS} کلمه است. لطفاً متن کوتاه‌تری را ارسال کنید.\n\nYour text exceeds the maximum limit of {MAX_WORDS} words. Please send a shorter text.")
+            send_message(chat_id, ERR_TOO_MANY_WORDS)
+            return
+        
+        # Reject texts that can't fit even with minimum font size before doing any image work
+        max_text_lines = get_max_text_lines()
+        if max_text_lines is not None and count_min_text_lines(title, text) > max_text_lines:
+            send_message(chat_id, ERR_TEXT_TOO_LONG)
             return
         
         # Reset user state
-        user_states[chat_id] = {}
+        user_state.step = None
+        user_state.title = ''
+        save_user_state(chat_id, user_state)
         
-        # Handle text processing
-        processing_msg = send_message(chat_id, "در حال پردازش متن شما...")
+        # Handle text processing: send the notice in the background while the images are rendered
+        processing_msg = TELEGRAM_EXECUTOR.submit(send_message, chat_id, MSG_PROCESSING)
         
         try:
-            # Create the image(s) with title and text
-            image_paths = create_text_image(title, text)
+            # Lay out and render the image(s) with title and text
+            images = get_text_images(title, text)
+            image_count = len(images)
+            
+            # Wait for the processing notice so the replies arrive after it
+            processing_msg.result()
             
-            if not image_paths:
+            if not image_count:
                 # Text is too long to fit even with minimum font size and max images
-                send_message(chat_id, "متن شما بسیار طولانی است. لطفاً متن کوتاه‌تری را ارسال کنید.\n\nYour text is too long. Please send a shorter text (maximum 4 images).")
+                send_message(chat_id, ERR_TEXT_TOO_LONG, START_KEYBOARD)
                 return
             
-            # If there are multiple images, inform the user
-            if len(image_paths) > 1:
-                send_message(chat_id, f"متن شما در {len(image_paths)} تصویر قرار داده شده است.\n\nYour text has been placed on {len(image_paths)} images.")
-            
-            # Send each image back to the user
-            for image_path in image_paths:
-                send_photo(chat_id, image_path)
-                
-                # Delete the temporary image file after sending
-                os.remove(image_path)
-            
-            # Send start button after processing is complete
-            send_start_button(chat_id)
+            # Send the image(s) back to the user (images are in memory, nothing to clean up)
+            if image_count > 1:
+                # Multiple images go out as one album captioned with their number; albums
+                # can't have buttons, so the start button follows in its own message
+                send_media_group(chat_id, images, MSG_IMAGE_COUNT.format(image_count))
+                send_message(chat_id, IMAGE_READY_CAPTION, START_KEYBOARD)
+            else:
+                # A single image comes with the start button
+                send_photo(chat_id, images[0], IMAGE_READY_CAPTION, START_KEYBOARD_JSON)
             
         except Exception as e:
             logger.error(f"Error processing text: {e}")
-            send_message(chat_id, "متأسفانه در پردازش متن شما مشکلی پیش آمد. لطفاً دوباره تلاش کنید.\n\nSorry, there was an error processing your text. Please try again.")
+            concurrent.futures.wait([processing_msg])
+            send_message(chat_id, ERR_PROCESSING, START_KEYBOARD)
     
     else:
         # User hasn't started the process
-        send_message(chat_id, 'لطفاً ابتدا /start را بفرستید تا فرآیند را شروع کنید.\n\nPlease send /start first to begin the process.')
+        send_message(chat_id, MSG_SEND_START_FIRST)
+
+def handle_update(update):
+    """Process a single update from Telegram."""
+    try:
+        # Process message if present
+        if 'message' in update:
+            handle_message(update['message'])
+        # Process callback query (button press) if present
+        elif 'callback_query' in update:
+            callback_query = update['callback_query']
+            chat_id = callback_query['message']['chat']['id']
+            if callback_query['data'] == 'start':
+                # Reset user state and ask for title
+                user_state = get_user_state(chat_id)
+                user_state.step = 'waiting_title'
+                user_state.title = ''
+                save_user_state(chat_id, user_state)
+                send_message(chat_id, MSG_ENTER_TITLE)
+    except Exception as e:
+        logger.error(f"Error handling update {update.get('update_id')}: {e}")
+
+def get_update_chat_id(update):
+    """Get the id of the chat an update belongs to, or None if it has none."""
+    if 'message' in update:
+        return update['message'].get('chat', {}).get('id')
+    if 'callback_query' in update:
+        return update['callback_query'].get('message', {}).get('chat', {}).get('id')
+    return None
+
+def dispatch_update(update):
+    """Queue an update for processing, after any earlier update of the same chat."""
+    chat_id = get_update_chat_id(update)
+    with _pending_chat_updates_lock:
+        pending = _pending_chat_updates.get(chat_id)
+        if pending is not None:
+            # An update of this chat is being processed; it picks this one up when done
+            pending.append(update)
+            return
+        _pending_chat_updates[chat_id] = collections.deque()
+    UPDATE_EXECUTOR.submit(process_chat_updates, chat_id, update)
+
+def process_chat_updates(chat_id, update):
+    """Process an update and then every update of the same chat queued behind it."""
+    while True:
+        handle_update(update)
+        with _pending_chat_updates_lock:
+            pending = _pending_chat_updates[chat_id]
+            if not pending:
+                del _pending_chat_updates[chat_id]
+                return
+            update = pending.popleft()
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    """Accept updates pushed by Telegram and queue them for processing."""
+    
+    def do_POST(self):
+        """Receive one update and answer right away; it is handled in the background."""
+        if self.path != (urllib.parse.urlsplit(WEBHOOK_URL).path or '/'):
+            self.send_error(404)
+            return
+        if WEBHOOK_SECRET and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            self.send_error(403)
+            return
+        
+        try:
+            update = orjson.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:  # Bad Content-Length or malformed JSON
+            self.send_error(400)
+            return
+        
+        # Acknowledge before processing so Telegram doesn't resend the update
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        dispatch_update(update)
+    
+    def log_message(self, format, *args):
+        """Route request logs through the bot's logger instead of stderr."""
+        logger.debug("Webhook: " + format, *args)
+
+def set_webhook(url):
+    """Ask Telegram to push the handled update types to the given URL."""
+    data = {
+        "url": url,
+        "allowed_updates": orjson.loads(ALLOWED_UPDATES),
+        "max_connections": WEBHOOK_MAX_CONNECTIONS
+    }
+    if WEBHOOK_SECRET:
+        data["secret_token"] = WEBHOOK_SECRET
+    return post_json(SET_WEBHOOK_URL, data)
+
+def run_webhook_server():
+    """Register the webhook and serve incoming updates until interrupted."""
+    result = set_webhook(WEBHOOK_URL)
+    if not result.get('ok'):
+        logger.error(f"Failed to set webhook: {result.get('description')}")
+        return
+    
+    server = http.server.ThreadingHTTPServer(('', WEBHOOK_PORT), WebhookHandler)
+    print(f"Starting bot in webhook mode on port {WEBHOOK_PORT}...")
+    server.serve_forever()
 
 def get_updates(offset=None):
     """Get updates from Telegram Bot API."""
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    url = f"{API_BASE_URL}{token}/getUpdates"
-    params = {'timeout': 30}
+    params = {'timeout': LONG_POLL_TIMEOUT, 'allowed_updates': ALLOWED_UPDATES, 'limit': GET_UPDATES_LIMIT}
     if offset:
         params['offset'] = offset
-    response = requests.get(url, params=params)
-    return response.json()
+    response = SESSION.get(GET_UPDATES_URL, params=params, timeout=GET_UPDATES_TIMEOUT)
+    return orjson.loads(response.content)
 
 def main():
     """Start the bot."""
+    # Enable logging
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    
     # Check for Telegram bot token
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not token:
+    if not TELEGRAM_BOT_TOKEN:
         print("Error: No Telegram bot token found. Please set the TELEGRAM_BOT_TOKEN environment variable.")
         print("You can create a .env file based on .env.example")
         return
@@ -764,37 +1282,71 @@ def main():
     if not os.path.exists("fonts"):
         os.makedirs("fonts")
     
+    # Pillow-SIMD is a drop-in replacement; its versions carry a ".postN" suffix.
+    # Persian text is only shaped and ordered correctly with the raqm layout engine.
+    logger.info(f"Using Pillow {Image.__version__}{' (SIMD)' if '.post' in Image.__version__ else ''}, "
+                f"raqm layout: {'available' if features.check('raqm') else 'not available'}")
+    if not features.check('raqm'):
+        logger.error("Pillow has no raqm layout support, so Persian text will be drawn unshaped and in "
+                     "logical order; install libraqm (or libfribidi for the Pillow wheels) and reinstall Pillow")
+    
+    if STATE_DB_PATH:
+        open_state_db(STATE_DB_PATH)
+    
+    preload_fonts()
+    get_background_image()
+    get_max_text_lines()
+    if njit is not None:
+        # Compile the JIT functions for the argument types the layout uses
+        # (integer line widths, integer or fractional justification targets)
+        _wrap_line_ends_jit(np.ones(JIT_WRAP_MIN_WORDS), 1.0, 10)
+        justify_space_counts(10.0, 2, 1.0, 20)
+        justify_space_counts(10.0, 2, 1.0, 20.5)
+    # Prime the JPEG encoder so the first reply doesn't pay for its setup
+    Image.new('RGB', (16, 16)).save(io.BytesIO(), format='JPEG', **JPEG_SAVE_OPTIONS)
+    
+    if WEBHOOK_URL:
+        run_webhook_server()
+        return
+    
+    # getUpdates is refused while a webhook is registered, e.g. from an earlier webhook run
+    try:
+        post_json(DELETE_WEBHOOK_URL, {})
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
+        logger.warning(f"Could not remove webhook: {e}")
+    
     print("Starting bot...")
     last_update_id = None
+    retry_delay = POLL_RETRY_DELAY_MIN
     
     while True:
+        # Only network and response errors are retried; anything else is a bug
+        # and stops the bot so it gets noticed (Docker restarts the container)
         try:
             # Get updates from Telegram
             updates = get_updates(last_update_id)
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            logger.warning(f"Polling failed, retrying in about {retry_delay}s: {e}")
+            time.sleep(retry_delay + random.random())
+            retry_delay = min(retry_delay * 2, POLL_RETRY_DELAY_MAX)
+            continue
+        
+        if not updates.get('ok'):
+            # E.g. a bad token, another instance polling, or flood control
+            retry_after = updates.get('parameters', {}).get('retry_after')
+            delay = retry_after if retry_after else retry_delay
+            logger.warning(f"getUpdates refused ({updates.get('description')}), retrying in about {delay}s")
+            time.sleep(delay + random.random())
+            retry_delay = min(retry_delay * 2, POLL_RETRY_DELAY_MAX)
+            continue
+        retry_delay = POLL_RETRY_DELAY_MIN
+        
+        for update in updates.get('result', ()):
+            # Update the offset to acknowledge the update
+            last_update_id = update['update_id'] + 1
             
-            if updates.get('ok') and updates.get('result'):
-                for update in updates['result']:
-                    # Update the offset to acknowledge the update
-                    last_update_id = update['update_id'] + 1
-                    
-                    # Process message if present
-                    if 'message' in update:
-                        handle_message(update['message'])
-                    # Process callback query (button press) if present
-                    elif 'callback_query' in update:
-                        callback_query = update['callback_query']
-                        chat_id = callback_query['message']['chat']['id']
-                        if callback_query['data'] == 'start':
-                            # Reset user state and ask for title
-                            user_states[chat_id] = {'step': 'waiting_title'}
-                            send_message(chat_id, 'لطفاً ابتدا عنوان خود را وارد کنید:\n\nPlease enter your title first:')
-            
-            # Sleep briefly to avoid hitting rate limits
-            time.sleep(0.5)
-            
-        except Exception as e:
-            logger.error(f"Error in main loop: {e}")
-            time.sleep(5)  # Wait a bit longer if there's an error
+            # Process the update in the background and go straight back to polling
+            dispatch_update(update)
 
 if __name__ == '__main__':
     main()
@@ -4,8 +4,11 @@
 # Test script to verify paragraph indentation with Persian text
 import sys
 import os
+import random
+import unittest
 sys.path.append(os.path.dirname(__file__))
 
+import simple_bot
 from simple_bot import create_text_image
 
 def test_persian_indentation():
@@ -25,15 +28,51 @@ def test_persian_indentation():
     print("\nGenerating image...")
     
     # Create the image
-    image_paths = create_text_image(title, text)
+    images = create_text_image(title, text)
     
-    if image_paths:
-        print(f"✅ Success! Generated {len(image_paths)} image(s):")
-        for path in image_paths:
-            print(f"  - {path}")
+    if images:
+        print(f"✅ Success! Generated {len(images)} image(s):")
+        for name, buffer in images:
+            # Images are generated in memory; write them out for inspection
+            with open(name, 'wb') as image_file:
+                image_file.write(buffer.getvalue())
+            print(f"  - {name}")
         print("\nCheck the generated image(s) to see if Persian paragraph indentation is visible.")
     else:
         print("❌ Failed to generate image")
 
+def test_jit_wrapping_matches_python():
+    """Test that the numba-compiled wrapping and justification match the plain Python versions"""
+    if simple_bot.njit is None:
+        raise unittest.SkipTest("numba is not installed")
+    
+    rng = random.Random(0)
+    for case in range(500):
+        # Word widths like Pillow's measurements (whole pixels or 1/64 fractions),
+        # and arbitrary ones that make the float rounding order matter
+        word_count = rng.randint(1, 80)
+        if case % 3 == 0:
+            widths = [rng.randint(1, 300) for _ in range(word_count)]
+        elif case % 3 == 1:
+            widths = [rng.randint(64, 300 * 64) / 64 for _ in range(word_count)]
+        else:
+            widths = [rng.uniform(1, 300) for _ in range(word_count)]
+        space_width = rng.choice([20, 21.5, rng.uniform(1, 40)])
+        max_width = rng.randint(200, 3600)
+        
+        expected = simple_bot.wrap_line_ends(widths, space_width, max_width)
+        actual = simple_bot._wrap_line_ends_jit(simple_bot.np.array(widths, dtype=simple_bot.np.float64), space_width, max_width)
+        assert list(actual) == expected, (widths, space_width, max_width)
+        
+        words_width = sum(widths)
+        gaps = rng.randint(1, 20)
+        target_width = rng.choice([max_width, max_width - space_width * 4.25])
+        expected_counts = simple_bot.justify_space_counts.py_func(words_width, gaps, space_width, target_width)
+        assert simple_bot.justify_space_counts(words_width, gaps, space_width, target_width) == expected_counts
+
 if __name__ == "__main__":
     test_persian_indentation()
+    try:
+        test_jit_wrapping_matches_python()
+    except unittest.SkipTest as e:
+        print(f"Skipped the JIT check: {e}")